@@ -1,11 +1,129 @@
+import os
+import sqlite3
+import tempfile
 from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, flash, session, g
-from cave_sgbd_sqlite import DB, Utilisateur, Cave, Etagere, ReferenceBouteille, Bouteille, Note, Archive, CapacityError
+from queue import Queue
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g, send_from_directory
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
+from cave_sgbd_sqlite import DB, Utilisateur, Cave, Etagere, ReferenceBouteille, Bouteille, Note, Archive, CapacityError, UnitOfWork, _BOUTEILLE_SORT_WHITELIST
 
 # --- Initialisation Flask + Base ---
 app = Flask(__name__)
 app.secret_key = "dev"     # clé pour signer la session (cookie) -> en prod : valeur secrète et forte
-db = DB(); conn = db.conn  # connexion SQLite (fichier "cave.db"), créée dans DB._create()
+
+# --- Cache de bytecode Jinja ---
+# Chaque template n'est compilé qu'une fois ; le résultat est réutilisé par tous
+# les workers et survit aux redémarrages (dossier dans /tmp). auto_reload=False :
+# on ne re-vérifie pas le mtime des .html à chaque render_template.
+_jinja_cache_dir = os.path.join(tempfile.gettempdir(), "cave_jinja_cache")
+os.makedirs(_jinja_cache_dir, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_jinja_cache_dir)
+app.jinja_env.auto_reload = False
+
+# Vérifie au démarrage que l'échappement HTML accéléré en C de MarkupSafe est
+# présent : sans lui, chaque {{ ... }} des templates passe par l'échappement en
+# Python pur, nettement plus lent sur les pages listant beaucoup de lignes.
+# (L'autoescape reste activé partout : les commentaires utilisateurs doivent
+# toujours être échappés.)
+try:
+    from markupsafe import _speedups  # noqa: F401
+except ImportError:
+    print("AVERTISSEMENT : markupsafe._speedups absent, échappement HTML en "
+          "Python pur. Réinstaller MarkupSafe avec ses extensions C compilées.")
+
+# --- Cache applicatif (pages publiques) ---
+# Les données de /communaute et /references/<id> sont coûteuses (agrégats) mais
+# ne changent que quand quelqu'un note : on les garde 60 s en mémoire. On met en
+# cache les DONNÉES et pas la page rendue, car la barre de navigation affiche
+# l'utilisateur connecté.
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 60})
+
+# --- Images d'étiquettes hébergées localement ---
+# etiquette_url peut pointer vers /labels/<fichier> au lieu d'une URL externe.
+# Derrière nginx/Apache configurés en X-Accel-Redirect / XSendfile, Flask
+# n'émet qu'un en-tête et le serveur front envoie le fichier lui-même
+# (sendfile(2), les octets ne traversent jamais Python).
+LABELS_DIR = os.path.join(app.root_path, "labels")
+app.use_x_sendfile = bool(os.environ.get("USE_X_SENDFILE"))
+DB_NAME = "cave.db"
+db = DB(DB_NAME)           # crée les tables au démarrage (idempotent), cf. DB._create()
+
+# --- Pool de connexions SQLite ---
+# Une seule connexion partagée par tous les threads sérialise les requêtes (et peut
+# lever ProgrammingError). On garde donc un petit pool : chaque requête HTTP emprunte
+# une connexion dans before_request et la rend dans teardown_request.
+POOL_SIZE = 8
+
+def _nouvelle_connexion():
+    """Ouvre une connexion SQLite prête à entrer dans le pool (WAL + accès par nom de colonne)."""
+    # detect_types=0 : pas de convertisseurs Python par colonne (mêmes raisons
+    # que dans cave_sgbd_sqlite.DB)
+    c = sqlite3.connect(DB_NAME, check_same_thread=False, cached_statements=256,
+                        detect_types=0)
+    c.row_factory = sqlite3.Row
+    # WAL : les lecteurs ne bloquent plus les écrivains (et inversement)
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA foreign_keys=ON")
+    return c
+
+_pool = Queue(maxsize=POOL_SIZE)
+for _ in range(POOL_SIZE):
+    _pool.put(_nouvelle_connexion())
+
+# Colonnes de tri acceptées sur la page étagère : la whitelist vit dans le
+# modèle (frozenset), on la réutilise ici pour ne pas maintenir deux listes
+SORT_COLONNES = _BOUTEILLE_SORT_WHITELIST
+
+# --- Lectures avec contrôle de propriété (une seule requête) ---
+def fetch_etagere_owned(conn, etagere_id, user_id):
+    """Étagère + vérification de propriété en UNE requête (au lieu de
+       Etagere.find_by_id puis Cave.find_by_id). Retourne None si l'étagère
+       n'existe pas OU n'appartient pas à l'utilisateur (pas de distinction,
+       pour ne pas révéler l'existence des étagères des autres)."""
+    return conn.execute("""SELECT e.*, c.nom AS cave_nom, c.utilisateur_id
+                           FROM etagere e JOIN cave c ON c.id=e.cave_id
+                           WHERE e.id=? AND c.utilisateur_id=?""",
+                        (etagere_id, user_id)).fetchone()
+
+def fetch_bouteille_owned(conn, bouteille_id, user_id):
+    """Bouteille (avec sa référence et sa cave) + vérification de propriété en
+       UNE requête. Même convention : None pour 'introuvable' comme pour
+       'pas à vous'."""
+    return conn.execute("""SELECT b.*, r.domaine, r.nom, r.type, r.annee, r.region,
+                                  r.id AS ref_id, e.cave_id, c.utilisateur_id
+                           FROM bouteille b
+                           JOIN ref_bouteille r ON r.id=b.ref_id
+                           JOIN etagere e ON e.id=b.etagere_id
+                           JOIN cave c ON c.id=e.cave_id
+                           WHERE b.id=? AND c.utilisateur_id=?""",
+                        (bouteille_id, user_id)).fetchone()
+
+# --- Validation du formulaire d'ajout de bouteille ---
+def _parse_bouteille_form(form):
+    """Valide et convertit tout le formulaire d'ajout en UNE passe.
+       Avant, chaque champ passait par un int()/float() nu : une valeur mal
+       formée levait ValueError et renvoyait une page 500. Retourne
+       (data, erreurs) ; data vaut None dès qu'un champ est invalide."""
+    erreurs = []
+    data = {}
+    for champ in ("domaine", "nom", "type", "region"):
+        val = (form.get(champ) or "").strip()
+        if not val:
+            erreurs.append(f"Le champ '{champ}' est obligatoire.")
+        data[champ] = val
+    data["annee"] = form.get("annee", type=int)
+    if data["annee"] is None:
+        erreurs.append("Année invalide.")
+    prix = form.get("prix", type=float)
+    data["prix"] = prix if prix is not None else 0.0
+    quantite = form.get("quantite", type=int)
+    data["quantite"] = quantite if quantite and quantite > 0 else 1
+    data["note_personnelle"] = form.get("note_personnelle", type=int)
+    data["commentaire"] = form.get("commentaire")
+    data["etiquette_url"] = form.get("etiquette_url") or None  # URL facultative
+    return (None if erreurs else data), erreurs
 
 # --- Décorateur pour protéger les pages privées ---
 def login_required(view):
@@ -19,13 +137,52 @@ def login_required(view):
         return view(*a, **k)
     return wrap
 
+# Version du cache utilisateur stocké en session : à incrémenter quand un profil
+# est modifié en base, pour forcer les sessions déjà ouvertes à recharger.
+USER_CACHE_VERSION = 1
+
+def _memoriser_user(row):
+    """Copie les champs utiles de l'utilisateur dans le cookie de session signé,
+       pour éviter un SELECT à chaque requête HTTP."""
+    user = dict(id=row["id"], login=row["login"], nom=row["nom"], prenom=row["prenom"])
+    session["user"] = user
+    session["user_v"] = USER_CACHE_VERSION
+    return user
+
 # --- Hook exécuté avant chaque requête HTTP ---
 @app.before_request
 def load_user():
-    """Charge l'utilisateur courant depuis la session dans g.current_user.
-       g est un conteneur 'global' valable pour la requête en cours."""
+    """Emprunte une connexion au pool (g.conn) puis charge l'utilisateur courant
+       dans g.current_user. g est un conteneur 'global' valable pour la requête en cours.
+       L'utilisateur est lu depuis le cookie de session ; la base n'est interrogée
+       que si le cache est absent ou périmé (changement de USER_CACHE_VERSION)."""
+    g.conn = _pool.get()
+    # Curseur partagé pour le SQL écrit directement dans les vues : un seul
+    # objet curseur par requête HTTP au lieu d'un par exécution
+    g.cursor = g.conn.cursor()
+    user = session.get("user")
+    if user and session.get("user_v") == USER_CACHE_VERSION:
+        g.current_user = user
+        return
     uid = session.get("user_id")
-    g.current_user = Utilisateur.find_by_id(conn, uid) if uid else None
+    row = Utilisateur.find_by_id(g.conn, uid) if uid else None
+    g.current_user = _memoriser_user(row) if row else None
+
+@app.teardown_request
+def release_conn(exc):
+    """Rend la connexion au pool à la fin de la requête (même en cas d'erreur)."""
+    cursor = g.pop("cursor", None)
+    if cursor is not None:
+        cursor.close()
+    conn = g.pop("conn", None)
+    if conn is not None:
+        # Une requête interrompue (exception, 500) peut laisser une transaction
+        # ouverte qui détient le verrou d'écriture SQLite : rendue telle quelle
+        # au pool, elle bloquerait les écritures de toutes les autres connexions
+        # ("database is locked"). On annule donc avant de rendre la connexion.
+        if conn.in_transaction:
+            conn.rollback()
+        _pool.put(conn)
 
 # --- Variables injectées automatiquement dans tous les templates ---
 @app.context_processor
@@ -33,6 +190,13 @@ def inject_globals():
     """Permet d'utiliser 'current_user' dans n'importe quelle page Jinja2 (navbar, etc.)"""
     return dict(current_user=g.get("current_user"))
 
+# --- Images d'étiquettes ---
+@app.route("/labels/<path:name>")
+def label(name):
+    """Sert une image d'étiquette depuis labels/. conditional=True : réponses
+       304/Range gérées, le navigateur ne re-télécharge que si le fichier change."""
+    return send_from_directory(LABELS_DIR, name, conditional=True)
+
 # --- Pages d'accueil / redirections simples ---
 @app.route("/")
 def home():
@@ -55,7 +219,7 @@ def register():
     if request.method=="POST":
         # Création utilisateur ; le hash du mot de passe est géré dans Utilisateur.sauvegarder()
         u = Utilisateur(request.form["nom"], request.form["prenom"], login=request.form["login"],
-                        password=request.form["password"], conn=conn)
+                        password=request.form["password"], conn=g.conn)
         u.sauvegarder()
         flash("Compte créé. Connectez-vous.")
         return redirect(url_for("login"))
@@ -65,9 +229,10 @@ def register():
 def login():
     """Connexion : vérifie identifiant + mot de passe (hash), met l'id en session et redirige."""
     if request.method=="POST":
-        user = Utilisateur.authenticate(conn, request.form["login"], request.form["password"])
+        user = Utilisateur.authenticate(g.conn, request.form["login"], request.form["password"])
         if user:
             session["user_id"] = user["id"]  # Sauvegarde en session pour les prochaines requêtes
+            _memoriser_user(user)            # Cache l'utilisateur dans le cookie signé
             flash("Connecté.")
             return redirect(request.args.get("next") or url_for("dashboard"))
         flash("Identifiants invalides.")
@@ -88,7 +253,7 @@ def logout():
 @login_required
 def lister_caves():
     """Affiche les caves appartenant à l'utilisateur connecté."""
-    caves = Cave(None,"",conn=conn).obtenir(utilisateur_id=g.current_user["id"])
+    caves = Cave.obtenir(g.conn, utilisateur_id=g.current_user["id"])
     return render_template("caves.html", caves=caves)
 
 @app.route("/caves/ajouter", methods=["GET","POST"])
@@ -96,7 +261,7 @@ def lister_caves():
 def ajouter_cave():
     """Ajoute une cave pour l'utilisateur courant."""
     if request.method=="POST":
-        Cave(g.current_user["id"], request.form["nom"], conn=conn).sauvegarder()
+        Cave(g.current_user["id"], request.form["nom"], conn=g.conn).sauvegarder()
         flash("Cave ajoutée.")
         return redirect(url_for("lister_caves"))
     return render_template("ajouter_cave.html")
@@ -105,23 +270,29 @@ def ajouter_cave():
 @login_required
 def cave_detail(cave_id):
     """Détail d'une cave : liste ses étagères + formulaire pour en créer."""
-    cave = Cave.find_by_id(conn, cave_id)
+    cave = Cave.find_by_id(g.conn, cave_id)
     # Sécurité : un utilisateur ne peut voir que ses caves
     if not cave or cave["utilisateur_id"] != g.current_user["id"]:
         flash("Accès refusé.")
         return redirect(url_for("lister_caves"))
-    etageres = Etagere(None,"",0,conn=conn).obtenir(cave_id=cave_id)
-    return render_template("cave_detail.html", cave=cave, etageres=etageres)
+    etageres = Etagere.obtenir(g.conn, cave_id=cave_id)
+    # Places libres de toutes les étagères en une requête (pas de N+1)
+    restants = Etagere.capacite_restante_bulk(g.conn, cave_id=cave_id)
+    return render_template("cave_detail.html", cave=cave, etageres=etageres, restants=restants)
 
 @app.route("/caves/<int:cave_id>/etageres/ajouter", methods=["POST"])
 @login_required
 def cave_ajouter_etagere(cave_id):
     """Ajoute une étagère (nom + capacité) dans la cave si elle appartient au user."""
-    cave = Cave.find_by_id(conn, cave_id)
+    cave = Cave.find_by_id(g.conn, cave_id)
     if not cave or cave["utilisateur_id"] != g.current_user["id"]:
         flash("Accès refusé.")
         return redirect(url_for("lister_caves"))
-    Etagere(cave_id, request.form["nom"], int(request.form["capacite"]), conn=conn).sauvegarder()
+    capacite = request.form.get("capacite", type=int)
+    if not capacite or capacite < 1:
+        flash("Capacité invalide.")
+        return redirect(url_for("cave_detail", cave_id=cave_id))
+    Etagere(cave_id, request.form["nom"], capacite, conn=g.conn).sauvegarder()
     flash("Étagère ajoutée.")
     return redirect(url_for("cave_detail", cave_id=cave_id))
 
@@ -133,19 +304,20 @@ def cave_ajouter_etagere(cave_id):
 @login_required
 def etagere_detail(etagere_id):
     """Affiche le contenu d'une étagère (formulaire d'ajout + tableau triable)."""
-    e = Etagere.find_by_id(conn, etagere_id)
+    # Sécurité : lecture + contrôle de propriété en une requête
+    e = fetch_etagere_owned(g.conn, etagere_id, g.current_user["id"])
     if not e:
-        flash("Étagère introuvable.")
-        return redirect(url_for("lister_caves"))
-    cave = Cave.find_by_id(conn, e["cave_id"])
-    # Sécurité : vérifier que l'étagère appartient à une cave du user
-    if cave["utilisateur_id"] != g.current_user["id"]:
         flash("Accès refusé.")
         return redirect(url_for("lister_caves"))
-    # Paramètres de tri passés en query string (?sort=...&dir=...)
+    cave = dict(id=e["cave_id"], nom=e["cave_nom"])
+    # Paramètres de tri passés en query string (?sort=...&dir=...), validés ici
+    # pour que le modèle ne reçoive que des combinaisons connues (cache de requêtes)
     sort = request.args.get("sort","annee"); dir_ = request.args.get("dir","asc")
-    b = Bouteille(None,None,conn=conn)
-    bouteilles = b.obtenir(etagere_id=etagere_id, sort=sort, dir=dir_)
+    if sort not in SORT_COLONNES:
+        sort = "annee"
+    if dir_ not in ("asc","desc"):
+        dir_ = "asc"
+    bouteilles = Bouteille.obtenir(g.conn, etagere_id=etagere_id, sort=sort, dir=dir_)
     return render_template("etagere_detail.html", cave=cave, etagere=e, bouteilles=bouteilles, sort=sort, dir=dir_)
 
 @app.route("/etageres/<int:etagere_id>/bouteilles/ajouter", methods=["POST"])
@@ -155,30 +327,34 @@ def etagere_ajouter_bouteille(etagere_id):
        - crée/retouve la référence (unique sur domaine/nom/type/année/région),
        - insère la bouteille (respect de la capacité),
        - redirige vers l'étagère."""
-    e = Etagere.find_by_id(conn, etagere_id)
+    e = fetch_etagere_owned(g.conn, etagere_id, g.current_user["id"])
     if not e:
-        flash("Étagère introuvable.")
-        return redirect(url_for("lister_caves"))
-    cave = Cave.find_by_id(conn, e["cave_id"])
-    if cave["utilisateur_id"] != g.current_user["id"]:
         flash("Accès refusé.")
         return redirect(url_for("lister_caves"))
+    # Validation/conversion de tous les champs en une passe
+    f, erreurs = _parse_bouteille_form(request.form)
+    if f is None:
+        for msg in erreurs:
+            flash(msg)
+        return redirect(url_for("etagere_detail", etagere_id=etagere_id))
     try:
-        etiquette = request.form.get("etiquette_url") or None  # URL facultative (aucune image par défaut)
-        # 1) Création/obtention de la référence (contrainte UNIQUE dans la base)
-        ref = ReferenceBouteille(request.form["domaine"], request.form["nom"], request.form["type"],
-                                 int(request.form["annee"]), request.form["region"],
-                                 etiquette_url=etiquette, conn=conn)
-        ref.sauvegarder()
-        # 2) Ajout de la bouteille (contrôle de capacité dans Bouteille.sauvegarder)
-        b = Bouteille(ref.id, etagere_id, prix=float(request.form.get("prix") or 0),
-                      commentaire=request.form.get("commentaire"),
-                      note_personnelle=request.form.get("note_personnelle", type=int),
-                      quantite=int(request.form.get("quantite") or 1), conn=conn)
-        b.sauvegarder()
+        # Les deux INSERT partagent UNE transaction (un seul fsync) : si la
+        # capacité est dépassée à l'étape 2, la référence de l'étape 1 est
+        # annulée aussi au lieu de rester orpheline
+        with UnitOfWork(g.conn):
+            # 1) Création/obtention de la référence (contrainte UNIQUE dans la base)
+            ref = ReferenceBouteille(f["domaine"], f["nom"], f["type"], f["annee"], f["region"],
+                                     etiquette_url=f["etiquette_url"], conn=g.conn)
+            ref.sauvegarder()
+            # 2) Ajout de la bouteille (contrôle de capacité dans Bouteille.sauvegarder)
+            b = Bouteille(ref.id, etagere_id, prix=f["prix"],
+                          commentaire=f["commentaire"],
+                          note_personnelle=f["note_personnelle"],
+                          quantite=f["quantite"], conn=g.conn)
+            b.sauvegarder()
         flash("Bouteille ajoutée.")
     except CapacityError as ex:
-        # Si dépassement de capacité -> message d'erreur
+        # Si dépassement de capacité -> message d'erreur (transaction annulée)
         flash(str(ex))
     return redirect(url_for("etagere_detail", etagere_id=etagere_id))
 
@@ -190,16 +366,12 @@ def etagere_ajouter_bouteille(etagere_id):
 @login_required
 def detail_bouteille(bouteille_id):
     """Page détail d'un lot : permet de modifier le prix/quantité/note perso, ou de déplacer d'étagère."""
-    row = Bouteille.find_by_id(conn, bouteille_id)
+    row = fetch_bouteille_owned(g.conn, bouteille_id, g.current_user["id"])
     if not row:
-        flash("Bouteille introuvable.")
-        return redirect(url_for("lister_caves"))
-    cave = Cave.find_by_id(conn, row["cave_id"])
-    if cave["utilisateur_id"] != g.current_user["id"]:
         flash("Accès refusé.")
         return redirect(url_for("lister_caves"))
     # Liste des étagères de la même cave pour permettre le déplacement
-    etageres = Etagere(None,"",0,conn=conn).obtenir(cave_id=cave["id"])
+    etageres = Etagere.obtenir(g.conn, cave_id=row["cave_id"])
     return render_template("bouteille_detail.html", b=row, etageres=etageres)
 
 @app.route("/bouteilles/<int:bouteille_id>/modifier", methods=["POST"])
@@ -207,21 +379,28 @@ def detail_bouteille(bouteille_id):
 def modifier_bouteille(bouteille_id):
     """Mise à jour d'un lot (prix, quantité, note perso, commentaire, déplacement).
        La méthode Bouteille.sauvegarder vérifie la capacité si on augmente ou si on change d'étagère."""
-    row = Bouteille.find_by_id(conn, bouteille_id)
+    row = fetch_bouteille_owned(g.conn, bouteille_id, g.current_user["id"])
     if not row:
-        flash("Bouteille introuvable.")
-        return redirect(url_for("lister_caves"))
-    cave = Cave.find_by_id(conn, row["cave_id"])
-    if cave["utilisateur_id"] != g.current_user["id"]:
         flash("Accès refusé.")
         return redirect(url_for("lister_caves"))
+    etagere_cible = request.form.get("etagere_id", type=int)
+    if etagere_cible is None:
+        flash("Étagère invalide.")
+        return redirect(url_for("detail_bouteille", bouteille_id=bouteille_id))
+    # Même contrôle que la capacité dans cave_ajouter_etagere : une quantité
+    # absente, non numérique ou < 1 ne doit ni provoquer un 500 ni créer un
+    # lot vide/négatif (le compteur 'occupee' et l'archivage s'y fient)
+    quantite = request.form.get("quantite", type=int)
+    if not quantite or quantite < 1:
+        flash("Quantité invalide.")
+        return redirect(url_for("detail_bouteille", bouteille_id=bouteille_id))
     try:
-        b = Bouteille(row["ref_id"], int(request.form["etagere_id"]),
+        b = Bouteille(row["ref_id"], etagere_cible,
                       prix=request.form.get("prix", type=float),
                       commentaire=request.form.get("commentaire"),
                       note_personnelle=request.form.get("note_personnelle", type=int),
-                      quantite=request.form.get("quantite", type=int),
-                      conn=conn, id=bouteille_id)
+                      quantite=quantite,
+                      conn=g.conn, id=bouteille_id)
         b.sauvegarder()
         flash("Bouteille mise à jour.")
     except CapacityError as e:
@@ -233,81 +412,120 @@ def modifier_bouteille(bouteille_id):
 def archiver_bouteille(bouteille_id):
     """Archive UNE unité (historique + décrémentation).
        Si quantité == 1 -> supprime le lot ; sinon quantité -= 1."""
-    row = Bouteille.find_by_id(conn, bouteille_id)
-    if row:
-        cave = Cave.find_by_id(conn, row["cave_id"])
-        if cave["utilisateur_id"] != g.current_user["id"]:
-            flash("Accès refusé.")
-            return redirect(url_for("lister_caves"))
-        # On reconstruit un objet Bouteille exploitable côté modèle
-        b = Bouteille(row["ref_id"], row["etagere_id"], prix=row["prix"], commentaire=row["commentaire"],
-                      note_personnelle=row["note_personnelle"], quantite=row["quantite"], conn=conn, id=bouteille_id)
-        # Ajoute une ligne dans 'archive' + met à jour la quantité
-        b.archiver_une(g.current_user["id"], note_personnelle=request.form.get("note_personnelle", type=int),
+    row = fetch_bouteille_owned(g.conn, bouteille_id, g.current_user["id"])
+    if not row:
+        flash("Accès refusé.")
+        return redirect(url_for("lister_caves"))
+    # On reconstruit un objet Bouteille exploitable côté modèle
+    b = Bouteille(row["ref_id"], row["etagere_id"], prix=row["prix"], commentaire=row["commentaire"],
+                  note_personnelle=row["note_personnelle"], quantite=row["quantite"], conn=g.conn, id=bouteille_id)
+    # Ajoute une ligne dans 'archive' + met à jour la quantité
+    b.archiver_une(g.current_user["id"], note_personnelle=request.form.get("note_personnelle", type=int),
+                   commentaire=request.form.get("commentaire"))
+    flash("Bouteille archivée (une unité).")
+    return redirect(url_for("etagere_detail", etagere_id=row["etagere_id"]))
+
+@app.route("/bouteilles/<int:bouteille_id>/archiver_lot", methods=["POST"])
+@login_required
+def archiver_lot_bouteille(bouteille_id):
+    """Archive PLUSIEURS unités d'un coup (champ 'count' du formulaire).
+       Une seule transaction pour les N lignes d'archive + la décrémentation."""
+    row = fetch_bouteille_owned(g.conn, bouteille_id, g.current_user["id"])
+    if not row:
+        flash("Accès refusé.")
+        return redirect(url_for("lister_caves"))
+    count = request.form.get("count", type=int) or 1
+    b = Bouteille(row["ref_id"], row["etagere_id"], prix=row["prix"], commentaire=row["commentaire"],
+                  note_personnelle=row["note_personnelle"], quantite=row["quantite"], conn=g.conn, id=bouteille_id)
+    n = b.archiver_lot(g.current_user["id"], count,
+                       note_personnelle=request.form.get("note_personnelle", type=int),
                        commentaire=request.form.get("commentaire"))
-        flash("Bouteille archivée (une unité).")
-    return redirect(url_for("etagere_detail", etagere_id=row["etagere_id"] if row else None))
+    flash(f"Bouteille archivée ({n} unité(s)).")
+    return redirect(url_for("etagere_detail", etagere_id=row["etagere_id"]))
 
 @app.route("/bouteilles/<int:bouteille_id>/supprimer", methods=["POST"])
 @login_required
 def supprimer_bouteille(bouteille_id):
     """Supprime entièrement le lot (sans passer par l'archive)."""
-    row = Bouteille.find_by_id(conn, bouteille_id)
-    if row:
-        cave = Cave.find_by_id(conn, row["cave_id"])
-        if cave["utilisateur_id"] != g.current_user["id"]:
-            flash("Accès refusé.")
-            return redirect(url_for("lister_caves"))
-    Bouteille.supprimer(conn, bouteille_id)
+    row = fetch_bouteille_owned(g.conn, bouteille_id, g.current_user["id"])
+    if not row:
+        flash("Accès refusé.")
+        return redirect(url_for("lister_caves"))
+    Bouteille.supprimer(g.conn, bouteille_id)
     flash("Bouteille supprimée (lot entier).")
-    return redirect(url_for("etagere_detail", etagere_id=row["etagere_id"] if row else None))
+    return redirect(url_for("etagere_detail", etagere_id=row["etagere_id"]))
 
 # =========================
 # Communauté (références & avis)
 # =========================
 
+@cache.cached(timeout=60, key_prefix="refs_communaute")
+def _refs_communaute():
+    """Références + moyennes, mises en cache 60 s (invalidé par noter_reference)."""
+    cur = g.cursor
+    # La moyenne est matérialisée sur ref_bouteille (mise à jour par chaque
+    # note) : plus de jointure ni d'agrégat à calculer au rendu
+    cur.execute("""SELECT r.*, r.avg_note AS moyenne
+                   FROM ref_bouteille r
+                   ORDER BY COALESCE(r.annee,0) DESC, r.id DESC""" )
+    return [dict(r) for r in cur.fetchall()]  # dicts : sérialisables par le cache
+
+@cache.memoize(timeout=60)
+def _reference_data(ref_id):
+    """(référence, moyenne, avis) pour une référence, mis en cache 60 s."""
+    ref = ReferenceBouteille.find_by_id(g.conn, ref_id)
+    if not ref:
+        return None
+    rb = ReferenceBouteille(ref["domaine"], ref["nom"], ref["type"], ref["annee"], ref["region"],
+                            etiquette_url=ref["etiquette_url"], conn=g.conn, id=ref_id)
+    moy = rb.moyenne_communaute()
+    notes = ReferenceBouteille.notes_for(g.conn, ref_id)
+    return dict(ref), moy, [dict(n) for n in notes]
+
 @app.route("/communaute")
 def communaute():
     """Liste toutes les références + leur moyenne des notes de la communauté."""
-    cur = conn.cursor()
-    cur.execute("""SELECT r.*, (SELECT AVG(note) FROM note WHERE ref_id=r.id) AS moyenne
-                   FROM ref_bouteille r ORDER BY COALESCE(annee,0) DESC, r.id DESC""" )
-    refs = cur.fetchall()
-    return render_template("communaute.html", refs=refs)
+    resp = app.make_response(render_template("communaute.html", refs=_refs_communaute()))
+    # 'private' : la page contient la barre de navigation personnalisée
+    resp.headers["Cache-Control"] = "private, max-age=30"
+    return resp
 
 @app.route("/references/<int:ref_id>")
 def reference_detail(ref_id):
     """Détail d'une référence : infos + moyenne + liste des avis + formulaire pour noter."""
-    ref = ReferenceBouteille.find_by_id(conn, ref_id)
-    if not ref:
+    data = _reference_data(ref_id)
+    if data is None:
         flash("Référence introuvable.")
         return redirect(url_for("communaute"))
-    # Objet pratique pour calculer la moyenne et récupérer les avis
-    rb = ReferenceBouteille(ref["domaine"], ref["nom"], ref["type"], ref["annee"], ref["region"],
-                            etiquette_url=ref["etiquette_url"], conn=conn, id=ref_id)
-    moy = rb.moyenne_communaute()
-    notes = ReferenceBouteille.notes_for(conn, ref_id)
-    return render_template("reference_detail.html", ref=ref, moyenne=moy, notes=notes)
+    ref, moy, notes = data
+    resp = app.make_response(render_template("reference_detail.html", ref=ref, moyenne=moy, notes=notes))
+    resp.headers["Cache-Control"] = "private, max-age=30"
+    return resp
 
 @app.route("/references/<int:ref_id>/noter", methods=["POST"])
 @login_required
 def noter_reference(ref_id):
     """Ajoute un avis de la communauté sur une référence (note + commentaire)."""
     Note(ref_id, g.current_user["id"], note=request.form.get("note", type=int),
-         commentaire=request.form.get("commentaire"), conn=conn).enregistrer()
+         commentaire=request.form.get("commentaire"), conn=g.conn).enregistrer()
+    # Invalide les caches qui contiennent cette moyenne
+    cache.delete("refs_communaute")
+    cache.delete_memoized(_reference_data, ref_id)
     flash("Note enregistrée.")
     return redirect(url_for("reference_detail", ref_id=ref_id))
 
 # =========================
-# Archives 
+# Archives
 # =========================
 
 @app.route("/archives")
 @login_required
 def lister_archives():
     """Affiche l'historique des bouteilles sorties par l'utilisateur."""
-    return render_template("archives.html", archives=Archive.lister(conn, utilisateur_id=g.current_user["id"]))
+    return render_template("archives.html", archives=Archive.lister(g.conn, utilisateur_id=g.current_user["id"]))
 
 # --- Lancement local ---
 if __name__ == "__main__":
-    app.run(debug=True)
+    # threaded=True : chaque requête a son thread ; le pool de connexions +
+    # le mode WAL permettent aux lectures/écritures SQLite de se recouvrir
+    app.run(debug=True, threaded=True)
@@ -1,20 +1,229 @@
+import json
 import sqlite3
-from datetime import date
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from werkzeug.security import generate_password_hash, check_password_hash
 
+# Argon2id si la bibliothèque est installée (voir requirements.txt) : hash
+# moderne, dur pour la mémoire, bien plus résistant au cassage que scrypt/pbkdf2.
+# Sans elle, on retombe sur le hash Werkzeug historique : rien ne casse.
+try:
+    from argon2 import PasswordHasher
+    _argon2 = PasswordHasher()
+except ImportError:
+    _argon2 = None
+
+
+def _hacher_mdp_direct(pwd):
+    """Hash un mot de passe : Argon2id si disponible, sinon Werkzeug."""
+    if _argon2 is not None:
+        return _argon2.hash(pwd)
+    return generate_password_hash(pwd)
+
+
+def _verifier_mdp_direct(hash_stocke, pwd):
+    """Vérifie un mot de passe quel que soit le format du hash stocké."""
+    if hash_stocke.startswith("$argon2"):
+        if _argon2 is None:
+            return False
+        try:
+            return _argon2.verify(hash_stocke, pwd)
+        except Exception:
+            return False
+    return check_password_hash(hash_stocke, pwd)
+
+
+# Un hash Argon2/Werkzeug coûte volontairement ~50-100 ms de CPU pur : exécuté
+# dans le processus du serveur, il monopolise un coeur pendant que les autres
+# requêtes attendent. On le délègue à un petit pool de processus, créé
+# paresseusement au premier login (les fonctions _direct ci-dessus sont au
+# niveau module, donc picklables). En cas de souci avec le pool, on retombe
+# sur l'appel direct : le login fonctionne toujours.
+_executeur_mdp = None
+
+
+def _pool_mdp():
+    global _executeur_mdp
+    if _executeur_mdp is None:
+        _executeur_mdp = ProcessPoolExecutor(max_workers=2)
+    return _executeur_mdp
+
+
+def hacher_mdp(pwd):
+    """Hash un mot de passe dans le pool de processus (ou en direct en repli)."""
+    try:
+        return _pool_mdp().submit(_hacher_mdp_direct, pwd).result()
+    except Exception:
+        global _executeur_mdp
+        _executeur_mdp = None   # pool cassé : on le laissera se recréer
+        return _hacher_mdp_direct(pwd)
+
+
+def verifier_mdp(hash_stocke, pwd):
+    """Vérifie un mot de passe dans le pool de processus (ou en direct en repli)."""
+    try:
+        return _pool_mdp().submit(_verifier_mdp_direct, hash_stocke, pwd).result()
+    except Exception:
+        global _executeur_mdp
+        _executeur_mdp = None
+        return _verifier_mdp_direct(hash_stocke, pwd)
+
 # Exception métier levée quand on dépasse la capacité d'une étagère
 class CapacityError(Exception):
     pass
 
+# La clause RETURNING nécessite SQLite >= 3.35 (mars 2021)
+_RETURNING_OK = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# json_each permet de passer toute une liste d'ids dans UN seul paramètre :
+# le texte SQL reste identique quelle que soit la taille de la liste, donc
+# le cache de requêtes préparées (cached_statements) est réutilisé au lieu
+# de recompiler un "IN (?,?,...)" différent à chaque longueur
+try:
+    sqlite3.connect(":memory:").execute("SELECT value FROM json_each('[1]')")
+    _JSON_EACH_OK = True
+except sqlite3.OperationalError:
+    _JSON_EACH_OK = False
+
+# Petit cache LRU (niveau module) des lignes renvoyées par find_by_id :
+# utilisateurs, caves et références changent rarement mais sont relus à chaque
+# page. Clé = (table, id). Les méthodes qui modifient une ligne l'évincent du
+# cache ; vider_cache_lignes() remet tout à zéro. Le serveur étant multi-thread,
+# un verrou protège chaque opération (get + move_to_end n'est pas atomique :
+# une éviction concurrente entre les deux ferait lever KeyError).
+# Les étagères ne sont PAS mises en cache : leur colonne 'occupee' est modifiée
+# par les triggers de la table bouteille, invisibles depuis Python.
+_ROW_CACHE_MAX = 512
+_row_cache = OrderedDict()
+_row_cache_verrou = threading.Lock()
+
+
+def _cache_lire(table, id):
+    cle = (table, id)
+    with _row_cache_verrou:
+        row = _row_cache.get(cle)
+        if row is not None:
+            _row_cache.move_to_end(cle)   # marquée "utilisée récemment"
+    return row
+
+
+def _cache_ecrire(table, id, row):
+    if row is None:
+        return
+    with _row_cache_verrou:
+        _row_cache[(table, id)] = row
+        if len(_row_cache) > _ROW_CACHE_MAX:
+            _row_cache.popitem(last=False)  # évince la plus ancienne
+
+
+def _cache_oublier(table, id):
+    with _row_cache_verrou:
+        _row_cache.pop((table, id), None)
+
+
+def vider_cache_lignes():
+    """Vide tout le cache de lignes (après une migration, ou dans les tests)."""
+    with _row_cache_verrou:
+        _row_cache.clear()
+
+
+# Connexions ayant une UnitOfWork en cours (id(conn) -> profondeur d'imbrication).
+# sqlite3.Connection n'accepte pas d'attribut arbitraire, d'où ce dict au niveau module.
+_uow_actives = {}
+
+
+def _dans_uow(conn):
+    return _uow_actives.get(id(conn), 0) > 0
+
+
+def _valider(conn):
+    """Commit, SAUF si une UnitOfWork englobe l'appel (elle validera à la sortie)."""
+    if not _dans_uow(conn):
+        conn.commit()
+
+
+@contextmanager
+def _transaction(conn):
+    """'with conn:' classique, sauf sous UnitOfWork : un 'with conn:' imbriqué
+       committerait la transaction englobante à sa sortie, on l'évite donc."""
+    if _dans_uow(conn):
+        yield conn
+    else:
+        with conn:
+            yield conn
+
+
+def _jour_julien(conn):
+    """Jour julien courant (entier) : format de stockage de archive.date_sortie,
+       4-8 octets et comparaisons d'entiers au lieu d'une chaîne ISO."""
+    # +0.5 : le jour julien change à midi, le décalage ramène la bascule à minuit
+    return conn.execute("SELECT CAST(julianday('now','localtime') + 0.5 AS INTEGER)").fetchone()[0]
+
+
+class UnitOfWork:
+    """Regroupe plusieurs écritures dans UNE transaction :
+
+           with UnitOfWork(conn):
+               ref.sauvegarder()
+               b.sauvegarder()
+
+       Les méthodes des modèles qui committent d'habitude détectent la
+       transaction ouverte et laissent le bloc with valider : un seul commit
+       (un seul fsync) à la sortie, rollback complet si une exception
+       traverse le bloc. Les UnitOfWork s'imbriquent, seule la plus externe
+       valide."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        _uow_actives[id(self.conn)] = _uow_actives.get(id(self.conn), 0) + 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        profondeur = _uow_actives[id(self.conn)] - 1
+        if profondeur:
+            _uow_actives[id(self.conn)] = profondeur
+        else:
+            del _uow_actives[id(self.conn)]
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        return False
+
 
 class DB:
     """Initialise la connexion SQLite et crée les tables au démarrage."""
 
     def __init__(self, db_name="cave.db"):
         # check_same_thread=False : autorise la même connexion depuis plusieurs threads (pratique en dev)
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        # cached_statements=256 : sqlite3 garde les requêtes préparées ; un texte SQL
+        # identique n'est plus re-parsé/re-planifié à chaque exécution
+        # detect_types=0 : aucun convertisseur Python par colonne ; les valeurs
+        # restent des types natifs SQLite, sans inspection des noms/déclarations
+        # de colonnes à chaque ligne lue (c'est le défaut, figé ici volontairement)
+        self.conn = sqlite3.connect(db_name, check_same_thread=False,
+                                    cached_statements=256, detect_types=0)
         # row_factory : permet d'accéder aux colonnes par leur nom (row["col"])
         self.conn.row_factory = sqlite3.Row
+        # Réglages SQLite : WAL (lecteurs et écrivains ne se bloquent plus),
+        # synchronous=NORMAL (un fsync par checkpoint au lieu d'un par commit),
+        # tables temporaires en RAM, fichier mappé en mémoire, cache de pages élargi
+        mode = self.conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if mode.lower() != "wal":
+            # Certains systèmes de fichiers (réseau) refusent le WAL : on le signale,
+            # l'application fonctionne mais les écritures redeviennent bloquantes
+            print(f"AVERTISSEMENT : journal_mode={mode} (WAL refusé), "
+                  "les écritures bloqueront les lectures.")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA mmap_size=268435456")   # 256 Mo
+        self.conn.execute("PRAGMA cache_size=-20000")     # ~20 Mo de cache de pages
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.execute("PRAGMA wal_autocheckpoint=1000")  # checkpoint toutes les ~1000 pages
         self._create()
 
     def _create(self):
@@ -55,11 +264,89 @@ class DB:
             ref_id INTEGER NOT NULL, utilisateur_id INTEGER NOT NULL,
             note INTEGER, commentaire TEXT)""")
 
-        # Archives (historique des sorties)
+        # Archives (historique des sorties). date_sortie : jour julien ENTIER
+        # (cf. _jour_julien), reformaté en YYYY-MM-DD par Archive.lister
         c.execute("""CREATE TABLE IF NOT EXISTS archive(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ref_id INTEGER NOT NULL, utilisateur_id INTEGER NOT NULL,
-            date_sortie TEXT NOT NULL, note_personnelle INTEGER, commentaire TEXT)""")
+            date_sortie INTEGER NOT NULL, note_personnelle INTEGER, commentaire TEXT)""")
+
+        # Migration : moyenne des notes matérialisée sur la référence.
+        # Mise à jour incrémentale à chaque note (cf. Note.enregistrer) ;
+        # les pages de liste lisent une colonne au lieu de recalculer l'AVG.
+        colonnes_ref = {r[1] for r in c.execute("PRAGMA table_info(ref_bouteille)").fetchall()}
+        if "avg_note" not in colonnes_ref:
+            c.execute("ALTER TABLE ref_bouteille ADD COLUMN avg_note REAL")
+            c.execute("ALTER TABLE ref_bouteille ADD COLUMN note_count INTEGER NOT NULL DEFAULT 0")
+            c.execute("""UPDATE ref_bouteille SET
+                avg_note=(SELECT AVG(note) FROM note WHERE ref_id=ref_bouteille.id AND note IS NOT NULL),
+                note_count=(SELECT COUNT(note) FROM note WHERE ref_id=ref_bouteille.id AND note IS NOT NULL)""")
+
+        # Migration : compteur de places occupées dénormalisé sur l'étagère.
+        # Tenu à jour par les triggers ci-dessous : capacite_restante devient
+        # une simple lecture de ligne au lieu d'un SUM sur les bouteilles.
+        colonnes_etagere = {r[1] for r in c.execute("PRAGMA table_info(etagere)").fetchall()}
+        if "occupee" not in colonnes_etagere:
+            c.execute("ALTER TABLE etagere ADD COLUMN occupee INTEGER NOT NULL DEFAULT 0")
+            c.execute("""UPDATE etagere SET occupee=COALESCE(
+                (SELECT SUM(quantite) FROM bouteille WHERE etagere_id=etagere.id), 0)""")
+
+        # Les triggers maintiennent 'occupee' quel que soit le chemin d'écriture
+        # (sauvegarder, executemany, DELETE groupé...) : impossible de l'oublier.
+        c.execute("""CREATE TRIGGER IF NOT EXISTS trg_bouteille_ins
+            AFTER INSERT ON bouteille BEGIN
+                UPDATE etagere SET occupee=occupee+NEW.quantite WHERE id=NEW.etagere_id;
+            END""")
+        c.execute("""CREATE TRIGGER IF NOT EXISTS trg_bouteille_del
+            AFTER DELETE ON bouteille BEGIN
+                UPDATE etagere SET occupee=occupee-OLD.quantite WHERE id=OLD.etagere_id;
+            END""")
+        # Couvre le changement de quantité ET le déplacement vers une autre
+        # étagère (retire de l'ancienne, ajoute à la nouvelle)
+        c.execute("""CREATE TRIGGER IF NOT EXISTS trg_bouteille_upd
+            AFTER UPDATE OF quantite, etagere_id ON bouteille BEGIN
+                UPDATE etagere SET occupee=occupee-OLD.quantite WHERE id=OLD.etagere_id;
+                UPDATE etagere SET occupee=occupee+NEW.quantite WHERE id=NEW.etagere_id;
+            END""")
+
+        # Migration : date_sortie passait par une chaîne ISO (10 octets +
+        # comparaisons de texte), elle devient un jour julien ENTIER. SQLite ne
+        # sait pas changer le type d'une colonne (l'affinité TEXT re-convertirait
+        # les entiers en texte), donc on reconstruit la table une fois.
+        types_archive = {r[1]: (r[2] or "").upper()
+                         for r in c.execute("PRAGMA table_info(archive)").fetchall()}
+        if types_archive.get("date_sortie") != "INTEGER":
+            c.execute("ALTER TABLE archive RENAME TO archive_ancienne")
+            c.execute("""CREATE TABLE archive(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ref_id INTEGER NOT NULL, utilisateur_id INTEGER NOT NULL,
+                date_sortie INTEGER NOT NULL, note_personnelle INTEGER, commentaire TEXT)""")
+            # julianday() accepte aussi bien l'ISO que le jour julien : idempotent
+            c.execute("""INSERT INTO archive
+                SELECT id, ref_id, utilisateur_id,
+                       CAST(julianday(date_sortie) + 0.5 AS INTEGER), note_personnelle, commentaire
+                FROM archive_ancienne""")
+            c.execute("DROP TABLE archive_ancienne")
+
+        # Index couvrant pour les moyennes de notes par référence (page communauté)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_note_ref ON note(ref_id, note)")
+
+        # Index pour les listes chaudes : caves d'un utilisateur, étagères d'une
+        # cave, bouteilles d'une étagère (évite les parcours complets de table)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_cave_user ON cave(utilisateur_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_etagere_cave ON etagere(cave_id)")
+        # (etagere_id, quantite) : sert les filtres par étagère et le backfill
+        # de 'occupee' ; remplace l'ancien index sur etagere_id seul
+        c.execute("DROP INDEX IF EXISTS idx_bouteille_etagere")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_bouteille_etagere_qte ON bouteille(etagere_id, quantite)")
+        # Jointures bouteille->référence et filtres d'Archive.lister
+        # (login est déjà indexé par sa contrainte UNIQUE)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_bouteille_ref ON bouteille(ref_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_archive_user ON archive(utilisateur_id, id DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_archive_ref ON archive(ref_id, id DESC)")
+
+        # Met à jour les statistiques du planificateur pour qu'il utilise ces index
+        c.execute("ANALYZE")
 
         self.conn.commit()
 
@@ -82,17 +369,23 @@ class Utilisateur:
         """Définit/Met à jour le mot de passe (stocké sous forme hashée)."""
         if not self.id:
             self.sauvegarder()
-        ph = generate_password_hash(pwd)
+        ph = hacher_mdp(pwd)
         self.conn.execute("UPDATE utilisateur SET password_hash=? WHERE id=?", (ph, self.id))
-        self.conn.commit()
+        _valider(self.conn)
+        _cache_oublier("utilisateur", self.id)
 
     @staticmethod
     def authenticate(conn, login, password):
         """Vérifie login + mot de passe (comparaison sur le hash)."""
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM utilisateur WHERE login=?", (login,))
-        row = cur.fetchone()
-        if row and row["password_hash"] and check_password_hash(row["password_hash"], password):
+        row = conn.execute("SELECT * FROM utilisateur WHERE login=?", (login,)).fetchone()
+        if row and row["password_hash"] and verifier_mdp(row["password_hash"], password):
+            # Migration paresseuse : les anciens hashs Werkzeug sont re-hashés
+            # en Argon2id au premier login réussi (on a le mot de passe en clair)
+            if _argon2 is not None and not row["password_hash"].startswith("$argon2"):
+                conn.execute("UPDATE utilisateur SET password_hash=? WHERE id=?",
+                             (hacher_mdp(password), row["id"]))
+                _valider(conn)
+                _cache_oublier("utilisateur", row["id"])
             return row
         return None
 
@@ -107,18 +400,21 @@ class Utilisateur:
                         (self.nom, self.prenom, self.login))
             self.id = cur.lastrowid
             if self._pwd:
-                ph = generate_password_hash(self._pwd)
+                ph = hacher_mdp(self._pwd)
                 cur.execute("UPDATE utilisateur SET password_hash=? WHERE id=?", (ph, self.id))
-        self.conn.commit()
+        _valider(self.conn)
+        _cache_oublier("utilisateur", self.id)
 
     @staticmethod
     def find_by_id(conn, id):
-        """Retourne l'utilisateur par id (ou None)."""
+        """Retourne l'utilisateur par id (ou None). Passe par le cache LRU."""
         if not id:
             return None
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM utilisateur WHERE id=?", (id,))
-        return cur.fetchone()
+        row = _cache_lire("utilisateur", id)
+        if row is None:
+            row = conn.execute("SELECT * FROM utilisateur WHERE id=?", (id,)).fetchone()
+            _cache_ecrire("utilisateur", id, row)
+        return row
 
 
 # -------------
@@ -143,23 +439,27 @@ class Cave:
             c.execute("INSERT INTO cave(utilisateur_id,nom) VALUES(?,?)",
                       (self.utilisateur_id, self.nom))
             self.id = c.lastrowid
-        self.conn.commit()
+        _valider(self.conn)
+        _cache_oublier("cave", self.id)
 
-    def obtenir(self, utilisateur_id=None):
-        """Liste les caves (option : filtrer par utilisateur)."""
-        c = self.conn.cursor()
+    @classmethod
+    def obtenir(cls, conn, utilisateur_id=None):
+        """Liste les caves (option : filtrer par utilisateur).
+           Méthode de classe : pas besoin de construire un objet Cave jetable."""
         if utilisateur_id:
-            c.execute("SELECT * FROM cave WHERE utilisateur_id=? ORDER BY nom", (utilisateur_id,))
+            c = conn.execute("SELECT * FROM cave WHERE utilisateur_id=? ORDER BY nom", (utilisateur_id,))
         else:
-            c.execute("SELECT * FROM cave ORDER BY nom")
+            c = conn.execute("SELECT * FROM cave ORDER BY nom")
         return c.fetchall()
 
     @staticmethod
     def find_by_id(conn, id):
-        """Détail d'une cave."""
-        c = conn.cursor()
-        c.execute("SELECT * FROM cave WHERE id=?", (id,))
-        return c.fetchone()
+        """Détail d'une cave. Passe par le cache LRU."""
+        row = _cache_lire("cave", id)
+        if row is None:
+            row = conn.execute("SELECT * FROM cave WHERE id=?", (id,)).fetchone()
+            _cache_ecrire("cave", id, row)
+        return row
 
 
 # ----------------
@@ -185,41 +485,64 @@ class Etagere:
             c.execute("INSERT INTO etagere(cave_id,nom,capacite) VALUES(?,?,?)",
                       (self.cave_id, self.nom, self.capacite))
             self.id = c.lastrowid
-        self.conn.commit()
+        _valider(self.conn)
 
-    def obtenir(self, cave_id=None, utilisateur_id=None):
+    @classmethod
+    def obtenir(cls, conn, cave_id=None, utilisateur_id=None):
         """Liste les étagères :
            - d'une cave donnée, ou
-           - de toutes les caves d'un utilisateur (jointure)."""
-        c = self.conn.cursor()
+           - de toutes les caves d'un utilisateur (jointure).
+           Méthode de classe : pas besoin de construire un objet Etagere jetable."""
         if cave_id:
-            c.execute("SELECT * FROM etagere WHERE cave_id=? ORDER BY nom", (cave_id,))
+            c = conn.execute("SELECT * FROM etagere WHERE cave_id=? ORDER BY nom", (cave_id,))
         elif utilisateur_id:
-            c.execute("""SELECT e.* FROM etagere e
-                         JOIN cave c ON c.id=e.cave_id
-                         WHERE c.utilisateur_id=?
-                         ORDER BY e.nom""", (utilisateur_id,))
+            c = conn.execute("""SELECT e.* FROM etagere e
+                                JOIN cave c ON c.id=e.cave_id
+                                WHERE c.utilisateur_id=?
+                                ORDER BY e.nom""", (utilisateur_id,))
         else:
-            c.execute("SELECT * FROM etagere ORDER BY nom")
+            c = conn.execute("SELECT * FROM etagere ORDER BY nom")
         return c.fetchall()
 
     @staticmethod
     def find_by_id(conn, id):
-        """Détail d'une étagère."""
-        c = conn.cursor()
-        c.execute("SELECT * FROM etagere WHERE id=?", (id,))
-        return c.fetchone()
+        """Détail d'une étagère. Volontairement HORS cache LRU : la colonne
+           'occupee' est modifiée par les triggers de la table bouteille, que
+           l'éviction Python ne voit pas ; une ligne en cache serait périmée."""
+        return conn.execute("SELECT * FROM etagere WHERE id=?", (id,)).fetchone()
 
     @staticmethod
     def capacite_restante(conn, etagere_id):
-        """Capacité restante = capacité - somme des quantités présentes."""
-        c = conn.cursor()
-        c.execute("SELECT capacite FROM etagere WHERE id=?", (etagere_id,))
-        row = c.fetchone()
-        cap = row["capacite"] if row else 0
-        c.execute("SELECT COALESCE(SUM(quantite),0) AS tot FROM bouteille WHERE etagere_id=?", (etagere_id,))
-        occ = c.fetchone()["tot"]
-        return cap - int(occ or 0)
+        """Capacité restante = capacite - occupee, simple lecture de la ligne :
+           le compteur 'occupee' est dénormalisé et tenu à jour par les triggers
+           sur la table bouteille (plus aucun SUM ici)."""
+        row = conn.execute("SELECT capacite - occupee AS restant FROM etagere WHERE id=?",
+                           (etagere_id,)).fetchone()
+        return int(row["restant"]) if row else 0
+
+    @staticmethod
+    def capacite_restante_bulk(conn, cave_id=None, utilisateur_id=None, etagere_ids=None):
+        """Capacités restantes de PLUSIEURS étagères en une requête.
+           Retourne {etagere_id: restant}. Même lecture directe du compteur
+           'occupee' que capacite_restante : plus de LEFT JOIN + GROUP BY.
+           Filtres : par cave, par utilisateur, ou liste d'ids d'étagères."""
+        sql = "SELECT e.id, e.capacite - e.occupee AS restant FROM etagere e "
+        params = []
+        if cave_id:
+            sql += "WHERE e.cave_id=?"
+            params.append(cave_id)
+        elif utilisateur_id:
+            sql += "JOIN cave c ON c.id=e.cave_id WHERE c.utilisateur_id=?"
+            params.append(utilisateur_id)
+        elif etagere_ids is not None:
+            ids = list(etagere_ids)
+            if _JSON_EACH_OK:
+                sql += "WHERE e.id IN (SELECT value FROM json_each(?))"
+                params.append(json.dumps(ids))
+            else:
+                sql += "WHERE e.id IN (" + ",".join("?" * len(ids)) + ")"
+                params.extend(ids)
+        return {r["id"]: int(r["restant"]) for r in conn.execute(sql, tuple(params))}
 
 
 # -------------------------
@@ -238,47 +561,148 @@ class ReferenceBouteille:
         self.etiquette_url = etiquette_url
         self.conn = conn
 
-    def sauvegarder(self):
+    def sauvegarder(self, commit=True):
         """Insère la référence si elle n'existe pas déjà (contrainte UNIQUE),
-           puis récupère son id (utile pour créer la bouteille)."""
-        c = self.conn.cursor()
-        c.execute("""INSERT OR IGNORE INTO ref_bouteille(domaine,nom,type,annee,region,etiquette_url)
-                     VALUES(?,?,?,?,?,?)""", (self.domaine, self.nom, self.type, self.annee, self.region, self.etiquette_url))
-        c.execute("""SELECT id FROM ref_bouteille
-                     WHERE domaine=? AND nom=? AND type=? AND annee=? AND region=?""",
-                  (self.domaine, self.nom, self.type, self.annee, self.region))
-        r = c.fetchone()
-        if r:
+           puis récupère son id (utile pour créer la bouteille).
+           commit=False : laisse l'appelant valider la transaction (ajout groupé)."""
+        valeurs = (self.domaine, self.nom, self.type, self.annee, self.region, self.etiquette_url)
+        if _RETURNING_OK:
+            # Un seul aller-retour : l'UPSERT renvoie l'id existant ou créé, et
+            # complète l'étiquette si la référence n'en avait pas encore
+            r = self.conn.execute(
+                """INSERT INTO ref_bouteille(domaine,nom,type,annee,region,etiquette_url)
+                   VALUES(?,?,?,?,?,?)
+                   ON CONFLICT(domaine,nom,type,annee,region)
+                   DO UPDATE SET etiquette_url=COALESCE(excluded.etiquette_url, ref_bouteille.etiquette_url)
+                   RETURNING id""", valeurs).fetchone()
             self.id = r["id"]
-        self.conn.commit()
+        else:
+            # SQLite trop ancien : INSERT OR IGNORE puis SELECT de l'id
+            c = self.conn.cursor()
+            c.execute("""INSERT OR IGNORE INTO ref_bouteille(domaine,nom,type,annee,region,etiquette_url)
+                         VALUES(?,?,?,?,?,?)""", valeurs)
+            c.execute("""SELECT id FROM ref_bouteille
+                         WHERE domaine=? AND nom=? AND type=? AND annee=? AND region=?""",
+                      (self.domaine, self.nom, self.type, self.annee, self.region))
+            r = c.fetchone()
+            if r:
+                self.id = r["id"]
+        if commit:
+            _valider(self.conn)
+        # L'UPSERT peut avoir complété l'étiquette d'une référence existante
+        _cache_oublier("ref_bouteille", self.id)
 
     @staticmethod
     def find_by_id(conn, rid):
-        """Retourne une référence par id."""
-        c = conn.cursor()
-        c.execute("SELECT * FROM ref_bouteille WHERE id=?", (rid,))
-        return c.fetchone()
+        """Retourne une référence par id. Passe par le cache LRU."""
+        row = _cache_lire("ref_bouteille", rid)
+        if row is None:
+            row = conn.execute("SELECT * FROM ref_bouteille WHERE id=?", (rid,)).fetchone()
+            _cache_ecrire("ref_bouteille", rid, row)
+        return row
 
     def moyenne_communaute(self):
-        """Calcule la moyenne des notes de la communauté pour cette référence."""
-        c = self.conn.cursor()
-        c.execute("SELECT AVG(note) AS m FROM note WHERE ref_id=? AND note IS NOT NULL", (self.id,))
-        r = c.fetchone()
-        return float(r["m"]) if r and r["m"] is not None else None
+        """Moyenne des notes de la communauté pour cette référence.
+           Lecture de la colonne matérialisée (tenue à jour par Note.enregistrer),
+           plus de balayage de la table des notes."""
+        r = self.conn.execute("SELECT avg_note FROM ref_bouteille WHERE id=?", (self.id,)).fetchone()
+        return float(r["avg_note"]) if r and r["avg_note"] is not None else None
+
+    @staticmethod
+    def details_bulk(conn, ref_ids):
+        """Moyennes et avis de PLUSIEURS références en deux requêtes au total,
+           au lieu de moyenne_communaute + notes_for appelées référence par
+           référence (2N requêtes). Retourne
+           {ref_id: {"moyenne": float|None, "nb": int, "notes": [Row, ...]}}."""
+        details = {rid: {"moyenne": None, "nb": 0, "notes": []} for rid in ref_ids}
+        ids = list(details)
+        if _JSON_EACH_OK:
+            # La liste entière passe dans un seul paramètre JSON : le texte SQL
+            # est constant et la requête préparée est réutilisée telle quelle
+            clause = "IN (SELECT value FROM json_each(?))"
+            params = (json.dumps(ids),)
+            for r in conn.execute(
+                    f"""SELECT ref_id, AVG(note) AS moy, COUNT(note) AS nb
+                        FROM note WHERE ref_id {clause} AND note IS NOT NULL
+                        GROUP BY ref_id""", params):
+                d = details[r["ref_id"]]
+                d["moyenne"] = float(r["moy"])
+                d["nb"] = r["nb"]
+            for r in conn.execute(
+                    f"""SELECT n.*, u.nom, u.prenom
+                        FROM note n JOIN utilisateur u ON u.id=n.utilisateur_id
+                        WHERE n.ref_id {clause} ORDER BY n.id DESC""", params):
+                details[r["ref_id"]]["notes"].append(r)
+            return details
+        # Repli pour les vieux SQLite sans module JSON : tranches de 500
+        # pour rester sous la limite de paramètres
+        for i in range(0, len(ids), 500):
+            lot = ids[i:i+500]
+            marques = ",".join("?" * len(lot))
+            for r in conn.execute(
+                    f"""SELECT ref_id, AVG(note) AS moy, COUNT(note) AS nb
+                        FROM note WHERE ref_id IN ({marques}) AND note IS NOT NULL
+                        GROUP BY ref_id""", lot):
+                d = details[r["ref_id"]]
+                d["moyenne"] = float(r["moy"])
+                d["nb"] = r["nb"]
+            for r in conn.execute(
+                    f"""SELECT n.*, u.nom, u.prenom
+                        FROM note n JOIN utilisateur u ON u.id=n.utilisateur_id
+                        WHERE n.ref_id IN ({marques}) ORDER BY n.id DESC""", lot):
+                details[r["ref_id"]]["notes"].append(r)
+        return details
 
     @staticmethod
     def notes_for(conn, ref_id):
         """Liste les avis (note + commentaire) avec nom/prénom des auteurs."""
-        c = conn.cursor()
-        c.execute("""SELECT n.*, u.nom, u.prenom
-                     FROM note n JOIN utilisateur u ON u.id=n.utilisateur_id
-                     WHERE ref_id=? ORDER BY n.id DESC""", (ref_id,))
+        c = conn.execute("""SELECT n.*, u.nom, u.prenom
+                            FROM note n JOIN utilisateur u ON u.id=n.utilisateur_id
+                            WHERE ref_id=? ORDER BY n.id DESC""", (ref_id,))
         return c.fetchall()
 
 
 # --------------
 # Modèle : Bouteille
 # --------------
+# Textes SQL de Bouteille.obtenir pré-construits à l'import : 9 tris × 2
+# directions × 4 formes de filtre = 72 chaînes figées. Plus aucun formatage de
+# chaîne dans le chemin chaud, et un texte stable reste indéfiniment dans le
+# cache de requêtes préparées de sqlite3.
+# Whitelist figée des colonnes triables : frozenset immuable, test d'appartenance
+# en O(1), partagée avec app.py pour que route et modèle ne divergent jamais
+_BOUTEILLE_SORT_WHITELIST = frozenset(
+    ("id","domaine","nom","type","annee","region","prix","quantite","note_personnelle"))
+
+# Normalisation de la direction : un simple .get() remplace les comparaisons
+# de chaînes, et tout paramètre inconnu retombe sur ASC
+_DIR_MAP = {"asc": "ASC", "desc": "DESC"}
+
+def _construire_sql_obtenir():
+    base = """
+    SELECT b.id,b.quantite,b.prix,b.commentaire,b.note_personnelle,b.etagere_id,
+           r.domaine,r.nom,r.type,r.annee,r.region,r.id AS ref_id,cave.utilisateur_id
+    FROM bouteille b
+    JOIN ref_bouteille r ON r.id=b.ref_id
+    JOIN etagere e ON e.id=b.etagere_id
+    JOIN cave ON cave.id=e.cave_id
+    """
+    filtres = {
+        (False, False): "",
+        (True,  False): " WHERE cave.utilisateur_id=?",
+        (False, True):  " WHERE b.etagere_id=?",
+        (True,  True):  " WHERE cave.utilisateur_id=? AND b.etagere_id=?",
+    }
+    sqls = {}
+    for sort_col in _BOUTEILLE_SORT_WHITELIST:
+        for direction in ("ASC", "DESC"):
+            for forme, where in filtres.items():
+                sqls[(sort_col, direction) + forme] = \
+                    base + where + f" ORDER BY {sort_col} {direction}, b.id ASC"
+    return sqls
+
+_SQL_OBTENIR = _construire_sql_obtenir()
+
 class Bouteille:
     """Lot physique placé sur une étagère (quantité, prix, note perso, commentaire).
        Règle clé : NE PAS dépasser la capacité de l'étagère."""
@@ -299,10 +723,11 @@ class Bouteille:
         if delta > restant:
             raise CapacityError(f"Capacité dépassée : reste {restant}, tentative +{delta}")
 
-    def sauvegarder(self):
+    def sauvegarder(self, commit=True):
         """Insert ou Update d'un lot :
            - en INSERT : vérifie la capacité sur la quantité initiale
-           - en UPDATE : gère l'augmentation de quantité et le déplacement d'étagère"""
+           - en UPDATE : gère l'augmentation de quantité et le déplacement d'étagère
+           commit=False : laisse l'appelant valider la transaction (ajout groupé)"""
         c = self.conn.cursor()
         if self.id:
             # Update : on récupère l'état précédent pour savoir quoi vérifier
@@ -331,72 +756,185 @@ class Bouteille:
                          VALUES(?,?,?,?,?,?)""",
                       (self.ref_id, self.etagere_id, self.prix, self.commentaire, self.note_personnelle, self.quantite))
             self.id = c.lastrowid
-        self.conn.commit()
+        if commit:
+            _valider(self.conn)
 
-    def obtenir(self, utilisateur_id=None, etagere_id=None, sort="annee", dir="asc"):
+    @staticmethod
+    def sauvegarder_many(conn, lots):
+        """Insère PLUSIEURS lots en une seule transaction.
+           lots : liste de tuples (ref_id, etagere_id, prix, commentaire,
+           note_personnelle, quantite). Les capacités sont vérifiées par étagère
+           via une requête groupée, puis un seul executemany + un seul commit
+           (un fsync au total) au lieu de N appels à sauvegarder()."""
+        if not lots:
+            return 0
+        demandes = {}
+        for (_ref, etagere_id, _prix, _comm, _note, quantite) in lots:
+            # Un lot vide ou négatif fausserait le total par étagère (et le
+            # compteur 'occupee') : on refuse la ligne avant tout INSERT
+            if int(quantite) < 1:
+                raise ValueError(f"Quantité invalide ({quantite}) pour l'étagère {etagere_id} : "
+                                 "chaque lot doit contenir au moins une bouteille.")
+            demandes[etagere_id] = demandes.get(etagere_id, 0) + int(quantite)
+        # On ne lit que les étagères concernées par le lot, pas toute la table
+        restants = Etagere.capacite_restante_bulk(conn, etagere_ids=demandes)
+        for etagere_id, total in demandes.items():
+            restant = restants.get(etagere_id, 0)
+            if total > restant:
+                raise CapacityError(f"Capacité dépassée sur l'étagère {etagere_id} : "
+                                    f"reste {restant}, tentative +{total}")
+        with _transaction(conn):
+            conn.executemany("""INSERT INTO bouteille(ref_id, etagere_id, prix, commentaire, note_personnelle, quantite)
+                                VALUES(?,?,?,?,?,?)""", lots)
+        return len(lots)
+
+    @classmethod
+    def obtenir(cls, conn, utilisateur_id=None, etagere_id=None, sort="annee", dir="asc", stream=False):
         """Liste les bouteilles avec tri.
            - sort : colonne triable (whitelist pour éviter l'injection SQL)
            - dir  : 'asc' ou 'desc'
            - filtres : par utilisateur (toutes ses étagères) ou par étagère
+           - stream=True : renvoie un générateur qui lit par paquets de 200
+             lignes au lieu de tout matérialiser en RAM (exports, gros comptes)
+           Le texte SQL est pris dans _SQL_OBTENIR (pré-construit à l'import).
         """
-        whitelist = {"id","domaine","nom","type","annee","region","prix","quantite","note_personnelle"}
-        sort_col = sort if sort in whitelist else "annee"
-        direction = "DESC" if str(dir).lower()=="desc" else "ASC"
-        c = self.conn.cursor()
-        base = """
-        SELECT b.id,b.quantite,b.prix,b.commentaire,b.note_personnelle,b.etagere_id,
-               r.domaine,r.nom,r.type,r.annee,r.region,r.id AS ref_id,cave.utilisateur_id
-        FROM bouteille b
-        JOIN ref_bouteille r ON r.id=b.ref_id
-        JOIN etagere e ON e.id=b.etagere_id
-        JOIN cave ON cave.id=e.cave_id
-        """
-        cond=[]; params=[]
+        sort_col = sort if sort in _BOUTEILLE_SORT_WHITELIST else "annee"
+        direction = _DIR_MAP.get(str(dir).lower(), "ASC")
+        sql = _SQL_OBTENIR[(sort_col, direction, bool(utilisateur_id), bool(etagere_id))]
+        params=[]
         if utilisateur_id:
-            cond.append("cave.utilisateur_id=?"); params.append(utilisateur_id)
+            params.append(utilisateur_id)
         if etagere_id:
-            cond.append("b.etagere_id=?"); params.append(etagere_id)
-        if cond:
-            base += " WHERE " + " AND ".join(cond)
-        base += f" ORDER BY {sort_col} {direction}, b.id ASC"
-        c.execute(base, tuple(params))
-        return c.fetchall()
+            params.append(etagere_id)
+        cur = conn.execute(sql, tuple(params))
+        if stream:
+            return cls._iterer(cur)
+        return cur.fetchall()
+
+    @staticmethod
+    def _iterer(cur):
+        """Générateur : lignes par paquets de 200 (fetchmany), mémoire bornée."""
+        cur.arraysize = 200
+        for paquet in iter(cur.fetchmany, []):
+            yield from paquet
 
     @staticmethod
     def find_by_id(conn, bid):
         """Retourne une bouteille avec les infos de sa référence + id de la cave (pour vérifier la propriété)."""
-        c = conn.cursor()
-        c.execute("""SELECT b.*, r.domaine, r.nom, r.type, r.annee, r.region, r.id AS ref_id, e.cave_id
-                     FROM bouteille b
-                     JOIN ref_bouteille r ON r.id=b.ref_id
-                     JOIN etagere e ON e.id=b.etagere_id
-                     WHERE b.id=?""", (bid,))
-        return c.fetchone()
+        return conn.execute("""SELECT b.*, r.domaine, r.nom, r.type, r.annee, r.region, r.id AS ref_id, e.cave_id
+                               FROM bouteille b
+                               JOIN ref_bouteille r ON r.id=b.ref_id
+                               JOIN etagere e ON e.id=b.etagere_id
+                               WHERE b.id=?""", (bid,)).fetchone()
 
     def archiver_une(self, utilisateur_id, note_personnelle=None, commentaire=None):
         """Archive UNE unité :
            - insère une ligne dans 'archive' avec la date du jour
            - décrémente la quantité (ou supprime le lot si c'était la dernière)
+           Avec RETURNING, la décrémentation renvoie directement la quantité
+           restante : plus de SELECT intermédiaire, et le DELETE n'est émis
+           que lorsque le lot est vide."""
+        with _transaction(self.conn):
+            self.conn.execute(
+                "INSERT INTO archive(ref_id, utilisateur_id, date_sortie, note_personnelle, commentaire) "
+                "VALUES(?,?,?,?,?)",
+                (self.ref_id, utilisateur_id, _jour_julien(self.conn), note_personnelle, commentaire)
+            )
+            if _RETURNING_OK:
+                r = self.conn.execute("UPDATE bouteille SET quantite=quantite-1 WHERE id=? RETURNING quantite",
+                                      (self.id,)).fetchone()
+                if r is not None and r["quantite"] <= 0:
+                    self.conn.execute("DELETE FROM bouteille WHERE id=?", (self.id,))
+            else:
+                # SQLite trop ancien : SELECT puis DELETE ou UPDATE
+                q = self.conn.execute("SELECT quantite FROM bouteille WHERE id=?", (self.id,)).fetchone()["quantite"]
+                if q <= 1:
+                    self.conn.execute("DELETE FROM bouteille WHERE id=?", (self.id,))
+                else:
+                    self.conn.execute("UPDATE bouteille SET quantite=quantite-1 WHERE id=?", (self.id,))
+
+    def archiver_lot(self, utilisateur_id, count, note_personnelle=None, commentaire=None):
+        """Archive 'count' unités d'un coup :
+           - executemany : une ligne d'archive par unité avec une seule requête préparée
+           - une seule transaction (un seul fsync), au lieu de N en bouclant archiver_une
         """
-        c = self.conn.cursor()
-        c.execute(
-            "INSERT INTO archive(ref_id, utilisateur_id, date_sortie, note_personnelle, commentaire) "
-            "VALUES(?,?,?,?,?)",
-            (self.ref_id, utilisateur_id, date.today().isoformat(), note_personnelle, commentaire)
-        )
-        c.execute("SELECT quantite FROM bouteille WHERE id=?", (self.id,))
-        q = c.fetchone()["quantite"]
-        if q <= 1:
-            c.execute("DELETE FROM bouteille WHERE id=?", (self.id,))
+        count = max(1, min(int(count), int(self.quantite or 0)))
+        aujourd_hui = _jour_julien(self.conn)   # calculé UNE fois pour tout le lot
+        lignes = [(self.ref_id, utilisateur_id, aujourd_hui, note_personnelle, commentaire)] * count
+        with _transaction(self.conn):
+            self.conn.executemany(
+                "INSERT INTO archive(ref_id, utilisateur_id, date_sortie, note_personnelle, commentaire) "
+                "VALUES(?,?,?,?,?)", lignes)
+            self.conn.execute("UPDATE bouteille SET quantite=quantite-? WHERE id=?", (count, self.id))
+            # Si tout le lot est sorti, on supprime la ligne (même règle qu'archiver_une)
+            self.conn.execute("DELETE FROM bouteille WHERE id=? AND quantite<=0", (self.id,))
+        return count
+
+    @staticmethod
+    def archiver_batch(conn, sorties):
+        """Archive des unités sur PLUSIEURS lots en une seule transaction.
+           sorties : liste de tuples (bouteille_id, utilisateur_id, count,
+           note_personnelle, commentaire). Trois requêtes préparées au total
+           (executemany INSERT + executemany UPDATE + un DELETE) et un seul
+           commit, au lieu d'une transaction par lot avec archiver_lot."""
+        if not sorties:
+            return 0
+        ids = [s[0] for s in sorties]
+        if _JSON_EACH_OK:
+            clause_ids = "IN (SELECT value FROM json_each(?))"
+            params_ids = (json.dumps(ids),)
         else:
-            c.execute("UPDATE bouteille SET quantite=quantite-1 WHERE id=?", (self.id,))
-        self.conn.commit()
+            clause_ids = "IN (" + ",".join("?" * len(ids)) + ")"
+            params_ids = tuple(ids)
+        cur = conn.execute(f"SELECT id, ref_id, quantite FROM bouteille WHERE id {clause_ids}",
+                           params_ids)
+        lots = {r["id"]: r for r in cur}
+        aujourd_hui = _jour_julien(conn)   # calculé UNE fois pour tout le batch
+        lignes, decrements, total = [], [], 0
+        for (bid, uid, count, note, comm) in sorties:
+            lot = lots.get(bid)
+            if lot is None:
+                continue
+            count = max(1, min(int(count), int(lot["quantite"] or 0)))
+            lignes.extend([(lot["ref_id"], uid, aujourd_hui, note, comm)] * count)
+            decrements.append((count, bid))
+            total += count
+        with _transaction(conn):
+            conn.executemany(
+                "INSERT INTO archive(ref_id, utilisateur_id, date_sortie, note_personnelle, commentaire) "
+                "VALUES(?,?,?,?,?)", lignes)
+            conn.executemany("UPDATE bouteille SET quantite=quantite-? WHERE id=?", decrements)
+            # Un seul DELETE balaie les lots vidés, restreint aux ids du batch :
+            # pas question de supprimer des lignes d'autres utilisateurs au passage
+            conn.execute(f"DELETE FROM bouteille WHERE id {clause_ids} AND quantite<=0",
+                         params_ids)
+        return total
+
+    @staticmethod
+    def stats_par_region(conn, utilisateur_id):
+        """Statistiques de la cave d'un utilisateur, agrégées par région EN SQL :
+           nombre de lots, total de bouteilles et prix moyen. Un seul GROUP BY
+           côté base au lieu de rapatrier toutes les bouteilles pour compter en
+           Python. Retourne les lignes (region, nb_lots, nb_bouteilles, prix_moyen),
+           régions les plus fournies en premier."""
+        return conn.execute(
+            """SELECT r.region,
+                      COUNT(*) AS nb_lots,
+                      SUM(b.quantite) AS nb_bouteilles,
+                      AVG(b.prix) AS prix_moyen
+               FROM bouteille b
+               JOIN ref_bouteille r ON r.id=b.ref_id
+               JOIN etagere e ON e.id=b.etagere_id
+               JOIN cave c ON c.id=e.cave_id
+               WHERE c.utilisateur_id=?
+               GROUP BY r.region
+               ORDER BY nb_bouteilles DESC, r.region""", (utilisateur_id,)).fetchall()
 
     @staticmethod
     def supprimer(conn, bid):
         """Supprime entièrement le lot (sans archivage)."""
         conn.execute("DELETE FROM bouteille WHERE id=?", (bid,))
-        conn.commit()
+        _valider(conn)
 
 
 # -----------
@@ -414,10 +952,37 @@ class Note:
         self.conn = conn
 
     def enregistrer(self):
-        """Insère la note (0-20) + commentaire éventuel."""
-        self.conn.execute("INSERT INTO note(ref_id,utilisateur_id,note,commentaire) VALUES(?,?,?,?)",
-                          (self.ref_id, self.utilisateur_id, self.note, self.commentaire))
-        self.conn.commit()
+        """Insère la note (0-20) + commentaire éventuel, et met à jour la moyenne
+           matérialisée de la référence dans la même transaction."""
+        with _transaction(self.conn):
+            self.conn.execute("INSERT INTO note(ref_id,utilisateur_id,note,commentaire) VALUES(?,?,?,?)",
+                              (self.ref_id, self.utilisateur_id, self.note, self.commentaire))
+            if self.note is not None:
+                # Moyenne incrémentale : (ancienne moyenne * n + note) / (n + 1)
+                self.conn.execute("""UPDATE ref_bouteille
+                    SET avg_note=(COALESCE(avg_note,0)*note_count + ?)/(note_count+1),
+                        note_count=note_count+1
+                    WHERE id=?""", (self.note, self.ref_id))
+                _cache_oublier("ref_bouteille", self.ref_id)
+
+    @staticmethod
+    def enregistrer_many(conn, avis):
+        """Insère PLUSIEURS avis en une seule transaction (import en masse).
+           avis : liste de tuples (ref_id, utilisateur_id, note, commentaire).
+           Les moyennes matérialisées des références touchées sont recalculées
+           en une passe à la fin plutôt qu'incrémentalement avis par avis."""
+        if not avis:
+            return 0
+        refs = {a[0] for a in avis}
+        with _transaction(conn):
+            conn.executemany("INSERT INTO note(ref_id,utilisateur_id,note,commentaire) VALUES(?,?,?,?)", avis)
+            conn.executemany("""UPDATE ref_bouteille SET
+                                  avg_note=(SELECT AVG(note) FROM note WHERE ref_id=? AND note IS NOT NULL),
+                                  note_count=(SELECT COUNT(note) FROM note WHERE ref_id=? AND note IS NOT NULL)
+                                WHERE id=?""", [(r, r, r) for r in refs])
+        for r in refs:
+            _cache_oublier("ref_bouteille", r)
+        return len(avis)
 
 
 # ---------------
@@ -433,7 +998,12 @@ class Archive:
            - filtrées par référence (historique d'un vin précis)
         """
         c = conn.cursor()
-        base = """SELECT a.*, u.nom, u.prenom, r.domaine, r.nom AS rnom, r.type, r.annee, r.region
+        # Colonnes explicites : date_sortie (jour julien entier) est reformatée
+        # en YYYY-MM-DD par date() au moment de l'affichage
+        base = """SELECT a.id, a.ref_id, a.utilisateur_id,
+                         date(a.date_sortie) AS date_sortie,
+                         a.note_personnelle, a.commentaire,
+                         u.nom, u.prenom, r.domaine, r.nom AS rnom, r.type, r.annee, r.region
                   FROM archive a JOIN utilisateur u ON u.id=a.utilisateur_id
                   JOIN ref_bouteille r ON r.id=a.ref_id"""
         cond=[]; params=[]